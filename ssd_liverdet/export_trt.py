@@ -0,0 +1,74 @@
+"""Export the fused multiphase SSD to ONNX and run the TensorRT engine built from it.
+
+    python export_trt.py --trained_model weights/ssd300_fused.pth --onnx ssd.onnx
+    trtexec --onnx=ssd.onnx --fp16 --saveEngine=ssd.plan --shapes=image:1x12x300x300
+
+Detect stays in PyTorch and runs on the engine outputs (see TRTSSD).
+"""
+from __future__ import print_function
+import argparse
+import torch
+import torch.nn as nn
+from layers import BatchedDetect
+from ssd_multiphase_custom_fused import build_ssd
+
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+
+class TRTSSD(object):
+    """Runs a serialized TensorRT engine built from SSD.export_onnx and
+    applies softmax + Detect to its loc/conf outputs, like SSD in test phase.
+
+    Args:
+        engine_path: (string) path of the .plan file written by trtexec
+        num_classes: (int) number of classes incl. background
+    """
+    def __init__(self, engine_path, num_classes, top_k=200, conf_thresh=0.01,
+                 nms_thresh=0.45):
+        import tensorrt as trt
+        self.trt = trt
+        logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, 'rb') as f:
+            self.engine = trt.Runtime(logger).deserialize_cuda_engine(f.read())
+        self.context = self.engine.create_execution_context()
+        self.softmax = nn.Softmax(dim=-1)
+        self.detect = BatchedDetect(num_classes, 0, top_k, conf_thresh, nms_thresh)
+
+    def __call__(self, x):
+        x = x.cuda().float().contiguous()
+        self.context.set_input_shape('image', tuple(x.shape))
+        outputs = {}
+        for i in range(self.engine.num_io_tensors):
+            name = self.engine.get_tensor_name(i)
+            if self.engine.get_tensor_mode(name) == self.trt.TensorIOMode.INPUT:
+                self.context.set_tensor_address(name, x.data_ptr())
+                continue
+            shape = tuple(self.context.get_tensor_shape(name))
+            outputs[name] = torch.empty(shape, dtype=torch.float32, device=x.device)
+            self.context.set_tensor_address(name, outputs[name].data_ptr())
+        self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream)
+        return self.detect(outputs['loc'], self.softmax(outputs['conf']),
+                           outputs['priors'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export fused SSD to ONNX / TensorRT')
+    parser.add_argument('--trained_model', default='weights/ssd300_fused.pth',
+                        type=str, help='Trained state_dict file path to open')
+    parser.add_argument('--onnx', default='weights/ssd300_fused.onnx', type=str,
+                        help='Path of the exported ONNX file')
+    parser.add_argument('--num_classes', default=2, type=int,
+                        help='Number of classes incl. background')
+    parser.add_argument('--batch_norm', default=True, type=str2bool,
+                        help='Model was trained with batch norm')
+    parser.add_argument('--opset', default=17, type=int, help='ONNX opset version')
+    args = parser.parse_args()
+
+    net = build_ssd('test', 300, args.num_classes, batch_norm=args.batch_norm)
+    net.load_weights(args.trained_model)
+    net.export_onnx(args.onnx, opset=args.opset)
+    print('Exported to %s, build the engine with:' % args.onnx)
+    print('trtexec --onnx=%s --fp16 --saveEngine=%s --shapes=image:1x12x300x300'
+          % (args.onnx, args.onnx.replace('.onnx', '.plan')))
@@ -1,5 +1,7 @@
 import torch
+import torch.nn as nn
 from torch.autograd import Function
+from torchvision.ops import batched_nms
 from ..box_utils import decode, nms
 from data import v2 as cfg
 
@@ -59,4 +61,73 @@ class Detect(Function):
         _, idx = flt[:, :, 0].sort(1, descending=True)
         _, rank = idx.sort(1)
         flt[(rank < self.top_k).unsqueeze(-1).expand_as(flt)].fill_(0)
-        return output
\ No newline at end of file
+        return output
+
+
+class BatchedDetect(nn.Module):
+    """Tensor-only Detect: same arguments and output layout, but decoding,
+    thresholding and per-class NMS run batched on the input device with
+    torchvision's batched_nms, without Python loops over images or classes.
+    Scriptable, so it can stay inside a TorchScript graph.
+    """
+    def __init__(self, num_classes, bkg_label, top_k, conf_thresh, nms_thresh):
+        super(BatchedDetect, self).__init__()
+        self.num_classes = num_classes
+        self.background_label = bkg_label
+        self.top_k = top_k
+        # Parameters used in nms.
+        self.nms_thresh = nms_thresh
+        if nms_thresh <= 0:
+            raise ValueError('nms_threshold must be non negative.')
+        self.conf_thresh = conf_thresh
+        self.variance = cfg['variance']
+
+    def forward(self, loc_data, conf_data, prior_data):
+        """
+        Args:
+            loc_data: (tensor) Loc preds from loc layers
+                Shape: [batch,num_priors,4]
+            conf_data: (tensor) Conf preds (after softmax) from conf layers
+                Shape: [batch,num_priors,num_classes]
+            prior_data: (tensor) Prior boxes and variances from priorbox layers
+                Shape: [num_priors,4]
+        Return:
+            (tensor) score and point-form box of the kept detections,
+                Shape: [batch,num_classes,top_k,5]
+        """
+        num = loc_data.size(0)  # batch size
+        num_priors = prior_data.size(0)
+        conf_data = conf_data.view(num, num_priors, self.num_classes)
+
+        # Decode predictions of the whole batch into point-form bboxes.
+        boxes = torch.cat((
+            prior_data[:, :2] + loc_data[..., :2] * self.variance[0] * prior_data[:, 2:],
+            prior_data[:, 2:] * torch.exp(loc_data[..., 2:] * self.variance[1])), -1)
+        boxes = torch.cat((boxes[..., :2] - boxes[..., 2:] / 2,
+                           boxes[..., :2] + boxes[..., 2:] / 2), -1)
+
+        # one candidate per (image, prior, foreground class) over the threshold
+        c_mask = conf_data.gt(self.conf_thresh)
+        c_mask[..., self.background_label] = False
+        idx = c_mask.nonzero()
+        img, prior, cl = idx[:, 0], idx[:, 1], idx[:, 2]
+        scores = conf_data[img, prior, cl]
+        boxes = boxes[img, prior]
+
+        # nms within each (image, class) group, kept indices by score
+        group = img * self.num_classes + cl
+        keep = batched_nms(boxes, scores, group, self.nms_thresh)
+
+        # rank of every kept box inside its group, to cap each at top_k
+        group, order = group[keep].sort(stable=True)
+        keep = keep[order]
+        counts = torch.bincount(group, minlength=num * self.num_classes)
+        starts = counts.cumsum(0) - counts
+        rank = torch.arange(group.numel(), device=group.device) - starts[group]
+        keep = keep[rank < self.top_k]
+        rank = rank[rank < self.top_k]
+
+        output = conf_data.new_zeros(num, self.num_classes, self.top_k, 5)
+        output[img[keep], cl[keep], rank] = torch.cat(
+            (scores[keep].unsqueeze(1), boxes[keep]), 1)
+        return output
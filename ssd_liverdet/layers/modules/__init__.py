@@ -1,4 +1,4 @@
-from .l2norm import L2Norm
+from .l2norm import L2Norm, l2norm_add_relu
 from .multibox_loss import MultiBoxLoss
 
-__all__ = ['L2Norm', 'MultiBoxLoss']
+__all__ = ['L2Norm', 'l2norm_add_relu', 'MultiBoxLoss']
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 from torch.autograd import Function
-from torch.autograd import Variable
 import torch.nn.init as init
 
 class L2Norm(nn.Module):
@@ -21,3 +20,20 @@ class L2Norm(nn.Module):
         x /= norm
         out = self.weight.unsqueeze(0).unsqueeze(2).unsqueeze(3).expand_as(x) * x
         return out
+
+
+@torch.jit.script
+def _l2norm_add_relu(a, b, weight_a, weight_b, eps):
+    # type: (Tensor, Tensor, Tensor, Tensor, float) -> Tensor
+    na = a * (weight_a.view(1, -1, 1, 1) / (a.pow(2).sum(dim=1, keepdim=True).sqrt() + eps))
+    nb = b * (weight_b.view(1, -1, 1, 1) / (b.pow(2).sum(dim=1, keepdim=True).sqrt() + eps))
+    return torch.relu(na + nb)
+
+
+def l2norm_add_relu(a, b, weight_a, weight_b, eps):
+    # type: (Tensor, Tensor, Tensor, Tensor, float) -> Tensor
+    """relu(L2Norm(a) + L2Norm(b)) as one scripted elementwise chain, so the
+    fuser can emit a single kernel instead of materializing both normed maps.
+    Plain function around the scripted kernel so FX can wrap it as one call.
+    """
+    return _l2norm_add_relu(a, b, weight_a, weight_b, eps)
@@ -0,0 +1,122 @@
+"""Carry a fused SSD checkpoint over to a changed layer configuration.
+
+Builds the fused SSD with the current module flags of
+ssd_multiphase_custom_fused (GROUPS_*, SEPARABLE_*, DECONV_53), copies every
+tensor of the old checkpoint that still fits, keeps the fresh initialisation
+for the rest and saves the result. Layers that changed shape (e.g. convs
+made depthwise separable) need fine-tuning afterwards.
+
+Layer indices inside the vgg and extras stacks shift when the flags change,
+so those are matched by role instead of by name: the n-th conv unit of a
+stack (one conv, or a depthwise + pointwise pair, with the BatchNorm after
+it) goes to the n-th unit of the new stack when all its shapes agree. The
+other layers are matched by name and shape. Old tensors without a
+destination are listed as dropped.
+
+    python migrate_weights.py --old weights/ssd300_fused.pth --new weights/ssd300_fused_sep.pth
+"""
+from __future__ import print_function
+import argparse
+from collections import OrderedDict
+import torch
+from ssd_multiphase_custom_fused import build_ssd
+
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+
+def stack_of(key):
+    # 'vgg' (flat legacy or split layout), 'extras' or None
+    if key.startswith('vgg.') or key.startswith('vgg_'):
+        return 'vgg'
+    if key.startswith('extras.'):
+        return 'extras'
+    return None
+
+
+def stack_units(state, stack):
+    """Group the tensors of one stack into conv units.
+
+    Return:
+        per conv unit, in layer order, a list of (module, params): its
+        conv(s), followed by its BatchNorm if there is one
+    """
+    modules = OrderedDict()
+    for key, value in state.items():
+        if stack_of(key) == stack:
+            module, _, param = key.rpartition('.')
+            modules.setdefault(module, OrderedDict())[param] = value
+    units = []
+    for module, params in modules.items():
+        last = units[-1] if units else None
+        if 'running_mean' in params:
+            # BN statistics only make sense with the conv they normalise
+            last.append((module, params))
+            continue
+        # a 1x1 conv right after a depthwise kxk conv completes its pair
+        if last is not None and len(last) == 1 and params['weight'].size(2) == 1:
+            prev = last[0][1]['weight']
+            if prev.size(1) == 1 and prev.size(2) > 1:
+                last.append((module, params))
+                continue
+        units.append([(module, params)])
+    return units
+
+
+def fits(old_params, new_params):
+    return set(old_params) == set(new_params) and all(
+        old_params[p].shape == new_params[p].shape for p in new_params)
+
+
+parser = argparse.ArgumentParser(description='Migrate fused SSD weights')
+parser.add_argument('--old', type=str, required=True,
+                    help='Checkpoint of the old configuration')
+parser.add_argument('--new', type=str, required=True,
+                    help='Path of the migrated checkpoint')
+parser.add_argument('--num_classes', default=2, type=int,
+                    help='Number of classes incl. background')
+parser.add_argument('--batch_norm', default=True, type=str2bool,
+                    help='Model was trained with batch norm')
+args = parser.parse_args()
+
+net = build_ssd('train', 300, args.num_classes, batch_norm=args.batch_norm)
+raw_state = torch.load(args.old, map_location=lambda storage, loc: storage)
+new_state = net.state_dict()
+
+# (old module, new module, params) triples: vgg and extras by role ...
+pairs = []
+for stack in ('vgg', 'extras'):
+    for old_unit, new_unit in zip(stack_units(raw_state, stack),
+                                  stack_units(new_state, stack)):
+        if len(old_unit) == len(new_unit) and all(
+                fits(o, n) for (_, o), (_, n) in zip(old_unit, new_unit)):
+            pairs += [(old, new, params)
+                      for (old, params), (new, _) in zip(old_unit, new_unit)]
+
+# ... everything else by name, after renaming legacy keys
+old_state = net.rename_legacy_keys(OrderedDict(
+    (k, v) for k, v in raw_state.items() if stack_of(k) is None))
+for key, value in old_state.items():
+    if key in new_state and new_state[key].shape == value.shape:
+        module, _, param = key.rpartition('.')
+        pairs.append((module, module, {param: value}))
+
+copied, used = set(), set()
+for old_module, new_module, params in pairs:
+    for param, value in params.items():
+        new_state[new_module + '.' + param] = value
+        copied.add(new_module + '.' + param)
+        used.add(old_module + '.' + param)
+net.load_state_dict(new_state)
+torch.save(net.state_dict(), args.new)
+
+skipped = [key for key in new_state if key not in copied]
+print('Copied %d tensors, re-initialised %d:' % (len(copied), len(skipped)))
+for key in skipped:
+    print('    ' + key)
+old_keys = [k for k in raw_state if stack_of(k) is not None] + list(old_state)
+dropped = [key for key in old_keys if key not in used]
+print('Dropped %d tensors of the old checkpoint:' % len(dropped))
+for key in dropped:
+    print('    ' + key)
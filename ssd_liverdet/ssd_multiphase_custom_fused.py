@@ -1,13 +1,28 @@
 import torch
+import torch.fx
+import torch.fx.experimental.optimization
 import torch.nn as nn
-import torch.nn.functional as F
-from torch.autograd import Variable
+from collections import OrderedDict
+from typing import Final, List, Tuple
 from layers import *
 from data import v2
 import os
 
-GROUPS_VGG = 1
+# scripted helper, called as an opaque node by FX tracing
+torch.fx.wrap('l2norm_add_relu')
+
+# the 12 input channels are 4 CT phases x 3: with GROUPS_VGG = 4 every vgg
+# conv sees one phase only, phases are mixed by the fusion convs at conv4_3
+# and by a 1x1 conv after fc7; the extras then run on mixed features
+GROUPS_VGG = 4
 GROUPS_EXTRA = 1
+# replace each 3x3 conv by a depthwise 3x3 + pointwise 1x1 pair; the
+# pointwise conv keeps GROUPS_* so phases stay separate when grouped
+SEPARABLE_VGG = False
+SEPARABLE_EXTRA = False
+# upsample conv5_3 with a learned 2x2 deconv (+BN) instead of a fixed
+# bilinear resize; needed to load checkpoints trained with the deconv
+DECONV_53 = False
 
 def xavier(param):
     nn.init.xavier_uniform(param)
@@ -18,6 +33,78 @@ def weights_init(m):
         xavier(m.weight.data)
         m.bias.data.zero_()
 
+
+def nearest_kernel(channels, kernel_size):
+    """ConvTranspose2d weight that copies each channel to its output pixels,
+    i.e. nearest-neighbour upsampling when stride == kernel_size.
+    Shape: [channels,channels,kernel_size,kernel_size]
+    """
+    weight = torch.zeros(channels, channels, kernel_size, kernel_size)
+    weight[range(channels), range(channels)] = 1
+    return weight
+
+
+def fuse_conv_bn(conv, bn):
+    """Fold an eval-mode BatchNorm2d into the preceding conv, in place.
+
+    W' = gamma / sqrt(var + eps) * W
+    b' = gamma * (b - mean) / sqrt(var + eps) + beta
+
+    Args:
+        conv: nn.Conv2d or nn.ConvTranspose2d feeding the BN
+        bn: nn.BatchNorm2d applied to the conv output
+    """
+    with torch.no_grad():
+        std = torch.sqrt(bn.running_var + bn.eps)
+        gamma = bn.weight if bn.weight is not None else torch.ones_like(std)
+        beta = bn.bias if bn.bias is not None else torch.zeros_like(std)
+        scale = gamma / std
+        if isinstance(conv, nn.ConvTranspose2d):
+            # deconv weight is laid out as [in, out, kh, kw]
+            conv.weight.mul_(scale.view(1, -1, 1, 1))
+        else:
+            conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        if conv.bias is None:
+            conv.bias = nn.Parameter(torch.zeros_like(bn.running_mean))
+        conv.bias.copy_((conv.bias - bn.running_mean) * scale + beta)
+    return conv
+
+
+def drop_identities(layers):
+    # copy of a (nested) Sequential without its nn.Identity placeholders
+    return nn.Sequential(*[drop_identities(v) if isinstance(v, nn.Sequential) else v
+                           for v in layers if not isinstance(v, nn.Identity)])
+
+
+def legacy_key_map(prefix, layers, root):
+    """Map the flat '<prefix>.<k>' module names of a layer list onto the
+    names the same modules have once registered under root.
+    """
+    names = {}
+    for name, module in root.named_modules(remove_duplicate=False):
+        names.setdefault(id(module), name)
+    return {'%s.%d' % (prefix, k): names[id(v)]
+            for k, v in enumerate(layers) if id(v) in names}
+
+
+class DetectLeafTracer(torch.fx.Tracer):
+    # keeps the data-dependent Detect layer as a single call_module node
+    def is_leaf_module(self, m, module_qualified_name):
+        return isinstance(m, BatchedDetect) or \
+            super(DetectLeafTracer, self).is_leaf_module(m, module_qualified_name)
+
+
+class MultiboxExport(nn.Module):
+    # wraps the deterministic (train-phase) outputs of an SSD for export
+    def __init__(self, ssd):
+        super(MultiboxExport, self).__init__()
+        self.ssd = ssd
+
+    def forward(self, x):
+        loc, conf = self.ssd.forward_multibox(x)
+        return loc, conf, self.ssd.priors
+
+
 class SSD(nn.Module):
     """Single Shot Multibox Architecture
     The network is composed of a base VGG network followed by the
@@ -32,56 +119,102 @@ class SSD(nn.Module):
         phase: (string) Can be "test" or "train"
         base: VGG16 layers for input, size of either 300 or 500
         extras: extra layers that feed to multibox loc and conf layers
-        head: "multibox head" consists of loc and conf conv layers
+        head: "multibox head", one conv per source producing the loc and
+            conf channels stacked (loc first)
     """
+    # constants for TorchScript, so branches on them are resolved at compile time
+    batch_norm: Final[bool]
+    is_test: Final[bool]
+    use_amp: Final[bool]
+    prior_offsets: Final[List[int]]
+    loc_channels: Final[List[int]]
+    # [input shape] + [shape of every source], filled by _specialize
+    source_shapes: List[List[int]]
 
     def __init__(self, phase, base, extras, head, num_classes, batch_norm):
         super(SSD, self).__init__()
         self.phase = phase
+        self.is_test = phase == 'test'
+        # fp16 autocast at test time lets cuDNN pick fused conv+bias+relu kernels
+        self.use_amp = self.is_test and torch.cuda.is_available()
         self.num_classes = num_classes
         self.batch_norm = batch_norm
         # TODO: implement __call__ in PriorBox
         self.priorbox = PriorBox(v2)
-        self.priors = Variable(self.priorbox.forward(), volatile=True)
+        # buffer follows the model across .cuda()/.to(), so no per-call cast
+        with torch.no_grad():
+            self.register_buffer('priors', self.priorbox.forward().float(),
+                                 persistent=False)
         self.size = 300
 
         # SSD network
-        self.vgg = nn.ModuleList(base)
+        # split vgg at conv4_3 and conv5_3 so each span runs as one module;
+        # the 4th and 5th max pools follow conv4_3 and conv5_3 relus
+        pools = [k for k, v in enumerate(base) if isinstance(v, nn.MaxPool2d)]
+        idx_until_conv4_3, idx_until_conv5_3 = pools[3], pools[4]
+        self.vgg_a = nn.Sequential(*base[:idx_until_conv4_3])
+        self.vgg_b = nn.Sequential(*base[idx_until_conv4_3:idx_until_conv5_3 - 1])
+        # conv5_3 relu; its output feeds both the fusion branch and vgg_d
+        self.vgg_c_last = base[idx_until_conv5_3 - 1]
+        self.vgg_d = nn.Sequential(*base[idx_until_conv5_3:])
 
         # Layer learns to scale the l2 normalized features from conv4_3
         self.L2Norm = L2Norm(512, 20)
-        self.extras = nn.ModuleList(extras)
-
-        self.loc = nn.ModuleList(head[0])
-        self.conf = nn.ModuleList(head[1])
+        # one stage of two (conv, bn?, relu) units per extra source layer
+        self.extras = nn.ModuleList(extra_stages(extras))
+        # checkpoints saved before the split use flat 'vgg.<k>' / 'extras.<k>' names
+        self._legacy_keys = legacy_key_map('vgg', base, self)
+        self._legacy_keys.update(legacy_key_map(
+            'extras', [v for unit in extras for v in unit], self))
+
+        self.head = nn.ModuleList(head)
+        # start of each source's priors in the flat [batch,num_priors,*] outputs
+        # and the number of leading loc channels of each head
+        self.prior_offsets = [0]
+        self.loc_channels = []
+        for f, h in zip(v2['feature_maps'], self.head):
+            num_anchors = h.out_channels // (4 + num_classes)
+            self.prior_offsets.append(self.prior_offsets[-1] + f * f * num_anchors)
+            self.loc_channels.append(num_anchors * 4)
 
         if phase == 'test':
             self.softmax = nn.Softmax(dim=-1)
-            self.detect = Detect(num_classes, 0, 200, 0.01, 0.45)
+            self.detect = BatchedDetect(num_classes, 0, 200, 0.01, 0.45)
 
         # feature fuse layers
         # fuse conv4_3 and conv5_3 feature map for improved small object detection
-        # layer for deconv of conv5_3 to match dim of conv4_3
-        self.fuse_deconv_53 = nn.ConvTranspose2d(512, 512,
-                                                 kernel_size=2, stride=2)
-        self.fuse_deconv_53.apply(weights_init)
-        if batch_norm:
-            self.bn_fuse_deconv_53 = nn.BatchNorm2d(512)
-        # init the deconv layer with bilinear upsampling
-        # TODO: how?
+        # layer for upsampling of conv5_3 to match dim of conv4_3
+        # each fuse layer is a (conv, bn?) Sequential so BN folding finds the pair
+        if DECONV_53:
+            # init the deconv layer as an exact nearest-neighbour upsample: a
+            # 2x2/stride 2 deconv has one tap per output pixel, so it cannot
+            # interpolate (a bilinear init needs k=4/s=2/p=1, which would
+            # break the checkpoint shapes)
+            deconv = nn.ConvTranspose2d(512, 512, kernel_size=2, stride=2)
+            deconv.weight.data.copy_(nearest_kernel(512, 2))
+            deconv.bias.data.zero_()
+            self.fuse_deconv_53 = nn.Sequential(
+                *([deconv, nn.BatchNorm2d(512)] if batch_norm else [deconv]))
+        else:
+            # fixed bilinear resize, fuse_conv_53 carries the learned transform
+            self.fuse_deconv_53 = nn.Sequential(
+                nn.Upsample(scale_factor=2, mode='bilinear', align_corners=False))
 
-        self.fuse_conv_53 = nn.Conv2d(512, 512, kernel_size=3, padding=1)
-        self.fuse_conv_53.apply(weights_init)
-        if batch_norm:
-            self.bn_fuse_conv_53 = nn.BatchNorm2d(512)
+        self.fuse_conv_53 = fuse_conv(512, 512, batch_norm)
         # L2 norm for fuse_conv_53
         self.L2Norm_53 = L2Norm(512, 10)
 
         # extra conv for conf4_3 for efficient fusing of fuse_conv5_3
-        self.fuse_conv_43 = nn.Conv2d(512, 512, kernel_size=3, padding=1)
-        self.fuse_conv_43.apply(weights_init)
-        if batch_norm:
-            self.bn_fuse_conv_43 = nn.BatchNorm2d(512)
+        self.fuse_conv_43 = fuse_conv(512, 512, batch_norm)
+        for name in ('fuse_deconv_53', 'fuse_conv_53', 'fuse_conv_43'):
+            self._legacy_keys[name] = name + '.0'
+            self._legacy_keys['bn_' + name] = name + '.1'
+
+        # (graph, static input, static outputs), see capture_cuda_graph
+        self._cuda_graph = None
+        # private allocator pool for inference, see reserve_memory_pool
+        self._mem_pool = None
+        self.source_shapes = []
 
 
     def forward(self, x):
@@ -93,9 +226,9 @@ class SSD(nn.Module):
         Return:
             Depending on phase:
             test:
-                Variable(tensor) of output class label predictions,
+                tensor of output class label predictions,
                 confidence score, and corresponding location predictions for
-                each object detected. Shape: [batch,topk,7]
+                each object detected. Shape: [batch,num_classes,topk,5]
 
             train:
                 list of concat outputs from:
@@ -103,109 +236,408 @@ class SSD(nn.Module):
                     2: localization layers, Shape: [batch,num_priors*4]
                     3: priorbox layers, Shape: [2,num_priors*4]
         """
+        if self.is_test:
+            if not torch.jit.is_scripting():
+                return self._forward_inference_mode(x)
+            return self._forward_test(x)
+        loc, conf = self.forward_multibox(x)
+        return loc, conf, self.priors
+
+    def _forward_test(self, x):
+        with torch.autocast(device_type='cuda', dtype=torch.float16,
+                            enabled=self.use_amp):
+            loc, conf = self.forward_multibox(x)
+        return self.detect(
+            loc.float(),                                    # loc preds
+            self.softmax(conf.float()),                     # conf preds
+            self.priors.float()                             # default boxes
+        )
+
+    @torch.jit.unused
+    def _forward_inference_mode(self, x):
+        # eager test phase: no autograd bookkeeping at all (not scriptable)
+        with torch.inference_mode():
+            return self._forward_test(x)
+
+    @torch.jit.export
+    def forward_multibox(self, x):
+        # type: (torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]
+        """Runs the network up to the multibox heads.
+
+        Return:
+            loc preds, Shape: [batch,num_priors,4]
+            conf preds (before softmax), Shape: [batch,num_priors,num_classes]
+        """
         sources = list()
-        loc = list()
-        conf = list()
 
-        # apply vgg up to conv4_3 relu
-        # TODO: change hardcoding 23 for BN case
-        if self.batch_norm is False:
-            idx_until_conv4_3 = 23
-        elif self.batch_norm is True:
-            idx_until_conv4_3 = 33
-        for k in range(idx_until_conv4_3):
-            x = self.vgg[k](x)
-        x_conv43 = x
+        # the model is built channels_last, keep the input in the same layout
+        # and in the weight dtype (see to_bfloat16_inference)
+        x = x.to(self.head[0].weight.dtype).contiguous(
+            memory_format=torch.channels_last)
 
         # apply vgg up to conv4_3 relu
-        if self.batch_norm is False:
-            idx_until_conv5_3 = 30
-        elif self.batch_norm is True:
-            idx_until_conv5_3 = 43
-        for k in range(idx_until_conv4_3, idx_until_conv5_3 - 1):
-            x = self.vgg[k](x)
-        x_conv53 = self.vgg[idx_until_conv5_3](x)
+        x_conv43 = self.vgg_a(x)
+
+        # apply vgg up to conv5_3 relu
+        x_conv53_pre_relu = self.vgg_b(x_conv43)
+        x_conv53 = self.vgg_c_last(x_conv53_pre_relu)
 
         # now x_conv43 is conv_43 and x_conv53 is conv_53
 
         # apply extra fusion conv at conv4_3
         fuse_conv43 = self.fuse_conv_43(x_conv43)
-        if self.batch_norm:
-            fuse_conv43 = self.bn_fuse_conv_43(fuse_conv43)
 
-        # apply deconv & extra fusion conv at conv5_3
+        # apply upsampling & extra fusion conv at conv5_3
         fuse_deconv53 = self.fuse_deconv_53(x_conv53)
-        if self.batch_norm:
-            fuse_deconv53 = self.bn_fuse_deconv_53(fuse_deconv53)
         fuse_conv53 = self.fuse_conv_53(fuse_deconv53)
-        if self.batch_norm:
-            fuse_conv53 = self.bn_fuse_deconv_53(fuse_conv53)
 
-        # apply L2norm at each fused convs
-        l2_fuse_conv43 = self.L2Norm(fuse_conv43)
-        l2_fuse_conv53 = self.L2Norm_53(fuse_conv53)
-
-        # apply sum and final relu to create source
-        s = F.relu(l2_fuse_conv43 + l2_fuse_conv53, inplace=True)
+        # apply L2norm at each fused convs, then sum and final relu to create
+        # source; done in one fused pass over both maps
+        s = l2norm_add_relu(fuse_conv43, fuse_conv53, self.L2Norm.weight,
+                            self.L2Norm_53.weight, self.L2Norm.eps)
 
         # TODO: append lower level features
         sources.append(s)
 
-        # fuse done, keep forward back from conv5_3
-        x = x_conv53
-
-        # apply vgg up to fc7
-        for k in range(idx_until_conv5_3, len(self.vgg)):
-            x = self.vgg[k](x)
+        # fuse done, keep forward back from conv5_3: pool5 up to fc7
+        x = self.vgg_d(x_conv53)
         sources.append(x)
 
         # apply extra layers and cache source layer outputs
-        # hard-coded for BN case
-        if self.batch_norm is False:
-            for k, v in enumerate(self.extras):
-                x = F.relu(v(x), inplace=True)
-                if k % 2 == 1:
-                    sources.append(x)
-        elif self.batch_norm is True:
-            for k, v in enumerate(self.extras):
-                x = v(x)
-                if k % 2 == 1:
-                    x = F.relu(x, inplace=True)
-                if k % 4 == 3:
-                    sources.append(x)
-
-        # apply multibox head to source layers
-        for (x, l, c) in zip(sources, self.loc, self.conf):
-            loc.append(l(x).permute(0, 2, 3, 1).contiguous())
-            conf.append(c(x).permute(0, 2, 3, 1).contiguous())
-
-        loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
-        conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
-        if self.phase == "test":
-            output = self.detect(
-                loc.view(loc.size(0), -1, 4),                   # loc preds
-                #self.softmax(conf.view(-1, self.num_classes)),  # conf preds
-                self.softmax(conf.view(conf.size(0), -1, self.num_classes)),
-                self.priors.type(type(x.data))                  # default boxes
-            )
-        else:
-            output = (
-                loc.view(loc.size(0), -1, 4),
-                conf.view(conf.size(0), -1, self.num_classes),
-                self.priors
-            )
-        return output
+        for v in self.extras:
+            x = v(x)
+            sources.append(x)
+
+        # apply multibox head to source layers, writing each result straight
+        # into its slice of the flat outputs (no per-head copies, no cat).
+        # head outputs are channels_last, so the NHWC permute is a free view
+        batch = x.size(0)
+        num_priors = self.prior_offsets[-1]
+        loc = sources[0].new_empty(batch, num_priors, 4)
+        conf = sources[0].new_empty(batch, num_priors, self.num_classes)
+        for i, h in enumerate(self.head):
+            start, end = self.prior_offsets[i], self.prior_offsets[i + 1]
+            y = h(sources[i]).permute(0, 2, 3, 1)
+            y_loc, y_conf = torch.split(
+                y, [self.loc_channels[i], y.size(3) - self.loc_channels[i]], dim=3)
+            # the split halves are strided views: copy them into an NHWC view
+            # of the output slice rather than reshaping them (a full copy)
+            loc.narrow(1, start, end - start).view(
+                batch, y.size(1), y.size(2), -1).copy_(y_loc)
+            conf.narrow(1, start, end - start).view(
+                batch, y.size(1), y.size(2), -1).copy_(y_conf)
+        return loc, conf
+
+    def capture_cuda_graph(self, batch_size=1):
+        """Captures forward_multibox for a fixed [batch_size,12,size,size]
+        input into a CUDA graph, replayed by forward_cuda_graph.
+
+        The model must already be on the GPU (and in eval mode); capture
+        again after changing the batch size or the weights.
+        """
+        static_input = torch.zeros(batch_size, 12, self.size, self.size,
+                                   device=self.priors.device)
+        static_input = static_input.contiguous(memory_format=torch.channels_last)
+
+        # warm up on a side stream so lazy cuDNN/JIT init is not captured
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.no_grad(), \
+                torch.autocast(device_type='cuda', dtype=torch.float16,
+                               enabled=self.use_amp):
+            for _ in range(3):
+                self.forward_multibox(static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(graph), \
+                torch.autocast(device_type='cuda', dtype=torch.float16,
+                               enabled=self.use_amp):
+            static_output = self.forward_multibox(static_input)
+        self._cuda_graph = (graph, static_input, static_output)
+
+    def forward_cuda_graph(self, x):
+        """Same output as forward, computed by replaying the captured graph.
+
+        In train phase the returned loc/conf are the graph's static
+        buffers and get overwritten by the next replay.
+        """
+        graph, static_input, (loc, conf) = self._cuda_graph
+        static_input.copy_(x)
+        graph.replay()
+        if self.is_test:
+            return self.detect(loc.float(), self.softmax(conf.float()),
+                               self.priors.float())
+        return loc, conf, self.priors
+
+    def reserve_memory_pool(self, batch_size=1):
+        """Creates a private CUDA memory pool for inference activations and
+        sizes it with one dry forward at [batch_size,12,size,size].
+
+        Run inference inside memory_pool() afterwards: activations are then
+        served from the pool's segments, which are reused call after call
+        instead of fragmenting the shared caching allocator.
+        """
+        self._mem_pool = torch.cuda.MemPool()
+        dummy = torch.zeros(batch_size, 12, self.size, self.size,
+                            device=self.priors.device)
+        with torch.no_grad(), self.memory_pool():
+            self(dummy)
+
+    def memory_pool(self):
+        """Context manager routing CUDA allocations to the reserved pool."""
+        return torch.cuda.use_mem_pool(self._mem_pool)
+
+    def export_onnx(self, path, opset=17):
+        """Folds BN and exports the network to ONNX.
+
+        The graph stops before Detect: it takes 'image' [B,12,size,size]
+        and returns 'loc', 'conf' (before softmax) and 'priors', with a
+        dynamic batch axis. Build a TensorRT engine from it with
+        export_trt.py / trtexec and run Detect on its outputs.
+        """
+        self.eval()
+        self.fuse_bn_for_inference()
+        dummy = torch.zeros(1, 12, self.size, self.size, device=self.priors.device)
+        torch.onnx.export(MultiboxExport(self), (dummy,), path,
+                          opset_version=opset,
+                          input_names=['image'],
+                          output_names=['loc', 'conf', 'priors'],
+                          dynamic_axes={'image': {0: 'B'}, 'loc': {0: 'B'},
+                                        'conf': {0: 'B'}})
+
+    def compile_for_inference(self):
+        """Traces the model with torch.fx and folds every Conv2d -> BatchNorm2d
+        edge found in the graph with torch.fx.experimental.optimization.fuse,
+        and every ConvTranspose2d -> BatchNorm2d edge (DECONV_53) with
+        fuse_conv_bn.
+
+        Returns a new GraphModule; the model itself is left untouched.
+        Detect stays a leaf call, and autocast is not part of the graph, so
+        wrap calls in torch.autocast yourself if wanted.
+        """
+        self.eval()
+        graph = DetectLeafTracer().trace(self)
+        gm = torch.fx.GraphModule(self, graph)
+
+        # a conv module called from several nodes, or whose output feeds
+        # more than one node, must not get a BN folded into it
+        modules = dict(gm.named_modules())
+        calls = {}
+        for node in gm.graph.nodes:
+            if node.op == 'call_module' and isinstance(
+                    modules[node.target], (nn.Conv2d, nn.ConvTranspose2d)):
+                calls[node.target] = calls.get(node.target, 0) + 1
+                assert len(node.users) == 1 or not any(
+                    isinstance(modules.get(user.target), nn.BatchNorm2d)
+                    for user in node.users), \
+                    'conv %s feeds a BN and other nodes' % node.target
+        shared = [name for name, count in calls.items() if count > 1]
+        assert not shared, 'convs used more than once: %s' % shared
+
+        # fuse works on a copy and only knows Conv2d -> BN, fold the deconvs
+        gm = torch.fx.experimental.optimization.fuse(gm, no_trace=True)
+        modules = dict(gm.named_modules())
+        for node in list(gm.graph.nodes):
+            if node.op != 'call_module' or \
+                    not isinstance(modules[node.target], nn.BatchNorm2d):
+                continue
+            prev = node.args[0]
+            if prev.op == 'call_module' and \
+                    isinstance(modules[prev.target], nn.ConvTranspose2d):
+                fuse_conv_bn(modules[prev.target], modules[node.target])
+                node.replace_all_uses_with(prev)
+                gm.graph.erase_node(node)
+                gm.delete_submodule(node.target)
+        gm.recompile()
+        return gm
+
+    def _specialize(self, batch_size=1):
+        """Runs a warm forward at [batch_size,12,size,size] and records the
+        input shape and the shape of every source in source_shapes.
+
+        The scripted model is specialized for exactly these shapes (see
+        build_scripted); call this again, and re-script, whenever the
+        deployment batch size changes, or every new shape pays for a JIT
+        re-specialization on its first calls.
+        """
+        dummy = torch.zeros(batch_size, 12, self.size, self.size,
+                            device=self.priors.device)
+        shapes = [list(dummy.shape)]
+        # every head conv is fed exactly one source
+        hooks = [h.register_forward_pre_hook(
+                     lambda m, inp: shapes.append(list(inp[0].shape)))
+                 for h in self.head]
+        try:
+            with torch.no_grad():
+                self.forward_multibox(dummy)
+        finally:
+            for hook in hooks:
+                hook.remove()
+        self.source_shapes = shapes
+        return shapes
+
+    @classmethod
+    def build_scripted(cls, phase, size=300, num_classes=21, batch_norm=False,
+                       base_file=None, batch_size=1):
+        """Builds the model, scripts it and freezes it for inference.
+
+        The JIT profiles and specializes the graph for the shapes of its
+        first calls, which are slow. The returned module has already been
+        warmed up under optimized_execution at [batch_size,12,size,size]
+        (see _specialize). Freezing keeps source_shapes, so callers can check
+        the locked input shape as scripted.source_shapes[0]; keep that shape
+        fixed afterwards, or build again for another batch size.
+        """
+        model = build_ssd(phase, size, num_classes, batch_norm)
+        if base_file is not None:
+            model.load_weights(base_file)
+        model.eval()
+        model._specialize(batch_size)
+        scripted = torch.jit.optimize_for_inference(torch.jit.freeze(
+            torch.jit.script(model), preserved_attrs=['source_shapes']))
+
+        dummy = torch.zeros(scripted.source_shapes[0], device=model.priors.device)
+        with torch.no_grad(), torch.jit.optimized_execution(True):
+            for _ in range(3):
+                scripted(dummy)
+        return scripted
 
     def load_weights(self, base_file):
         other, ext = os.path.splitext(base_file)
         if ext == '.pkl' or '.pth':
             print('Loading weights into state dict...')
             weight_pretrained = torch.load(base_file, map_location=lambda storage, loc: storage)
-            self.load_state_dict(weight_pretrained)
+            self.load_state_dict(self.rename_legacy_keys(weight_pretrained))
+            if self.phase == 'test':
+                self.fuse_bn_for_inference()
             print('Finished!')
         else:
             print('Sorry only .pth and .pkl files supported.')
 
+    def to_bfloat16_inference(self, dtype=torch.bfloat16):
+        """Folds BN and casts weights to dtype, torch.bfloat16 or
+        torch.float16. Inputs are cast on entry; the priors buffer stays
+        float32, as does the Detect layer. fp16 autocast is switched off,
+        the weights already carry the requested dtype.
+        """
+        self.fuse_bn_for_inference()
+        self.use_amp = False
+        # box decoding needs full precision priors, keep them out of the cast
+        priors = self.priors.float()
+        self.to(dtype)
+        self.priors = priors
+        return self
+
+    def quantize_int8(self, data_loader, num_batches=10, backend='fbgemm'):
+        """Static INT8 quantization of the VGG and extras blocks.
+
+        BN is folded first, then every vgg block and extras stage is
+        prepared with FX, calibrated on up to num_batches batches of
+        data_loader and converted to quantized conv(+relu) modules. The
+        fusion branch and the multibox heads stay in float32.
+        Quantized kernels run on CPU only.
+        """
+        from torch.ao.quantization import QConfigMapping, get_default_qconfig
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+        self.eval()
+        self.fuse_bn_for_inference()
+        qconfig_mapping = QConfigMapping().set_global(get_default_qconfig(backend))
+        blocks = [(self, 'vgg_a'), (self, 'vgg_b'), (self, 'vgg_d')] + \
+                 [(self.extras, str(k)) for k in range(len(self.extras))]
+
+        # record one input per block to trace it with
+        example_inputs = {}
+        hooks = [getattr(parent, name).register_forward_pre_hook(
+                     lambda module, inputs, key=(id(parent), name):
+                     example_inputs.setdefault(key, inputs))
+                 for parent, name in blocks]
+        with torch.no_grad():
+            self.forward_multibox(torch.zeros(1, 12, self.size, self.size))
+        for hook in hooks:
+            hook.remove()
+
+        for parent, name in blocks:
+            # folded BNs leave Identity layers that would split conv+relu
+            prepared = prepare_fx(drop_identities(getattr(parent, name)),
+                                  qconfig_mapping,
+                                  example_inputs[(id(parent), name)])
+            setattr(parent, name, prepared)
+        with torch.no_grad():
+            for k, (images, _) in enumerate(data_loader):
+                if k == num_batches:
+                    break
+                self.forward_multibox(images)
+        for parent, name in blocks:
+            setattr(parent, name, convert_fx(getattr(parent, name)))
+        return self
+
+    def rename_legacy_keys(self, state_dict):
+        """Rename state dict keys of the flat 'vgg.<k>' layout to the
+        current module paths and merge separate 'loc.<k>' / 'conf.<k>'
+        heads into 'head.<k>'. Keys already in the new layout pass through.
+        """
+        renamed = OrderedDict()
+        for key, value in state_dict.items():
+            module, _, param = key.rpartition('.')
+            module = self._legacy_keys.get(module, module)
+            renamed[module + '.' + param] = value
+        for k in range(len(self.head)):
+            for param in ('weight', 'bias'):
+                loc_key = 'loc.%d.%s' % (k, param)
+                conf_key = 'conf.%d.%s' % (k, param)
+                if loc_key in renamed and conf_key in renamed:
+                    renamed['head.%d.%s' % (k, param)] = torch.cat(
+                        (renamed.pop(loc_key), renamed.pop(conf_key)), 0)
+        return renamed
+
+    def fuse_bn_for_inference(self):
+        """Absorb every BatchNorm2d into the conv right before it.
+
+        Covers every (conv, BN) pair inside an nn.Sequential: the vgg
+        blocks, the extras units and the fuse_* layers. Each folded BN is
+        replaced by nn.Identity(), so indices and the forward pass stay
+        unchanged.
+        Only valid with frozen running statistics, i.e. at test time;
+        the resulting state dict no longer carries BN keys.
+        """
+        if not self.batch_norm:
+            return
+        for layers in self.modules():
+            if not isinstance(layers, nn.Sequential):
+                continue
+            for k in range(len(layers) - 1):
+                if isinstance(layers[k], (nn.Conv2d, nn.ConvTranspose2d)) \
+                        and isinstance(layers[k + 1], nn.BatchNorm2d):
+                    fuse_conv_bn(layers[k], layers[k + 1])
+                    layers[k + 1] = nn.Identity()
+
+
+def fuse_conv(in_channels, out_channels, batch_norm=False):
+    # 3x3 conv of the conv4_3/conv5_3 fusion branch, with optional BN
+    conv = nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1)
+    conv.apply(weights_init)
+    if batch_norm:
+        return nn.Sequential(conv, nn.BatchNorm2d(out_channels))
+    return nn.Sequential(conv)
+
+
+def conv_layers(in_channels, out_channels, kernel_size, groups=1,
+                separable=False, **kwargs):
+    # a single conv, or a depthwise + pointwise pair for separable kxk convs
+    if separable and kernel_size > 1:
+        return [nn.Conv2d(in_channels, in_channels, kernel_size=kernel_size,
+                          groups=in_channels, **kwargs),
+                nn.Conv2d(in_channels, out_channels, kernel_size=1, groups=groups)]
+    return [nn.Conv2d(in_channels, out_channels, kernel_size=kernel_size,
+                      groups=groups, **kwargs)]
+
+
+def out_channels(layers):
+    # channels produced by the last conv of a layer list
+    return [v for v in layers if isinstance(v, nn.Conv2d)][-1].out_channels
+
 
 # This function is derived from torchvision VGG make_layers()
 # https://github.com/pytorch/vision/blob/master/torchvision/models/vgg.py
@@ -218,81 +650,81 @@ def vgg(cfg, i, batch_norm=False):
         elif v == 'C':
             layers += [nn.MaxPool2d(kernel_size=2, stride=2, ceil_mode=True)]
         else:
-            # depthwise separable conv: add groups=4 (4 phases)
-            conv2d = nn.Conv2d(in_channels, v, kernel_size=3, padding=1, groups=GROUPS_VGG)
+            # grouped conv: add groups=4 (4 phases)
+            conv2d = conv_layers(in_channels, v, 3, groups=GROUPS_VGG,
+                                 separable=SEPARABLE_VGG, padding=1)
             if batch_norm:
-                layers += [conv2d, nn.BatchNorm2d(v), nn.ReLU(inplace=True)]
+                layers += conv2d + [nn.BatchNorm2d(v), nn.ReLU(inplace=True)]
             else:
-                layers += [conv2d, nn.ReLU(inplace=True)]
+                layers += conv2d + [nn.ReLU(inplace=True)]
             in_channels = v
     pool5 = nn.MaxPool2d(kernel_size=3, stride=1, padding=1)
-    conv6 = nn.Conv2d(512, 1024, kernel_size=3, padding=6, dilation=6, groups=GROUPS_VGG)
-    conv7 = nn.Conv2d(1024, 1024, kernel_size=1, groups=GROUPS_VGG)
+    conv6 = conv_layers(512, 1024, 3, groups=GROUPS_VGG, separable=SEPARABLE_VGG,
+                        padding=6, dilation=6)
+    conv7 = conv_layers(1024, 1024, 1, groups=GROUPS_VGG)
     if batch_norm:
-        layers += [pool5,
-                   conv6, nn.BatchNorm2d(1024), nn.ReLU(inplace=True),
-                   conv7, nn.BatchNorm2d(1024), nn.ReLU(inplace=True)]
+        layers += [pool5] + \
+                  conv6 + [nn.BatchNorm2d(1024), nn.ReLU(inplace=True)] + \
+                  conv7 + [nn.BatchNorm2d(1024), nn.ReLU(inplace=True)]
     else:
-        layers += [pool5, conv6,
-                   nn.ReLU(inplace=True), conv7, nn.ReLU(inplace=True)]
+        layers += [pool5] + conv6 + \
+                  [nn.ReLU(inplace=True)] + conv7 + [nn.ReLU(inplace=True)]
+    if GROUPS_VGG > 1:
+        # cross-phase mixer for the per-phase fc7 streams
+        mixer = nn.Conv2d(1024, 1024, kernel_size=1)
+        if batch_norm:
+            layers += [mixer, nn.BatchNorm2d(1024), nn.ReLU(inplace=True)]
+        else:
+            layers += [mixer, nn.ReLU(inplace=True)]
     return layers
 
 
 def add_extras(cfg, i, batch_norm=False):
     # Extra layers added to VGG for feature scaling
+    # returns one [conv(s), bn?] list per conv of cfg, relus are added later
     layers = []
     in_channels = i
     flag = False
     for k, v in enumerate(cfg):
         if in_channels != 'S':
             if v == 'S':
-                if batch_norm is False:
-                    layers += [nn.Conv2d(in_channels, cfg[k + 1],
-                           kernel_size=(1, 3)[flag], stride=2, padding=1, groups=GROUPS_EXTRA)]
-                else:
-                    layers += [nn.Conv2d(in_channels, cfg[k + 1],
-                                         kernel_size=(1, 3)[flag], stride=2, padding=1, groups=GROUPS_EXTRA),
-                               nn.BatchNorm2d(cfg[k + 1])]
-
+                unit = conv_layers(in_channels, cfg[k + 1], (1, 3)[flag],
+                                   groups=GROUPS_EXTRA, separable=SEPARABLE_EXTRA,
+                                   stride=2, padding=1)
+                if batch_norm:
+                    unit += [nn.BatchNorm2d(cfg[k + 1])]
             else:
-                if batch_norm is False:
-                    layers += [nn.Conv2d(in_channels, v, kernel_size=(1, 3)[flag], groups=GROUPS_EXTRA)]
-                else:
-                    layers += [nn.Conv2d(in_channels, v, kernel_size=(1, 3)[flag], groups=GROUPS_EXTRA),
-                               nn.BatchNorm2d(v)]
+                unit = conv_layers(in_channels, v, (1, 3)[flag],
+                                   groups=GROUPS_EXTRA, separable=SEPARABLE_EXTRA)
+                if batch_norm:
+                    unit += [nn.BatchNorm2d(v)]
+            layers += [unit]
             flag = not flag
         in_channels = v
     return layers
 
 
+def extra_stages(units):
+    # regroup the add_extras() output into one Sequential per source,
+    # made of two (conv, bn?, relu) units so conv+relu can be fused
+    units = [nn.Sequential(*(unit + [nn.ReLU()])) for unit in units]
+    return [nn.Sequential(*units[k:k + 2]) for k in range(0, len(units), 2)]
+
+
 def multibox(vgg, extra_layers, cfg, num_classes, batch_norm):
-    loc_layers = []
-    conf_layers = []
-    # hard-coded
-    # TODO: make this generic
-    if batch_norm is False:
-        vgg_source = [21, -2]
-    elif batch_norm is True:
-        vgg_source = [30, -3]
+    # one conv per source for both loc and conf, split after the conv
+    head_layers = []
+    # sources: conv4_3 (last conv before the 4th pool) and fc7
+    pools = [k for k, v in enumerate(vgg) if isinstance(v, nn.MaxPool2d)]
+    vgg_source = [out_channels(vgg[:pools[3]]), out_channels(vgg)]
     for k, v in enumerate(vgg_source):
-        loc_layers += [nn.Conv2d(vgg[v].out_channels,
-                                 cfg[k] * 4, kernel_size=3, padding=1)]
-        conf_layers += [nn.Conv2d(vgg[v].out_channels,
-                        cfg[k] * num_classes, kernel_size=3, padding=1)]
-    # hard-coded
-    if batch_norm is False:
-        for k, v in enumerate(extra_layers[1::2], 2):
-            loc_layers += [nn.Conv2d(v.out_channels, cfg[k]
-                                     * 4, kernel_size=3, padding=1)]
-            conf_layers += [nn.Conv2d(v.out_channels, cfg[k]
-                                      * num_classes, kernel_size=3, padding=1)]
-    elif batch_norm is True:
-        for k, v in enumerate(extra_layers[2::4], 2):
-            loc_layers += [nn.Conv2d(v.out_channels, cfg[k]
-                                     * 4, kernel_size=3, padding=1)]
-            conf_layers += [nn.Conv2d(v.out_channels, cfg[k]
-                                      * num_classes, kernel_size=3, padding=1)]
-    return vgg, extra_layers, (loc_layers, conf_layers)
+        head_layers += [nn.Conv2d(v, cfg[k] * (4 + num_classes),
+                                  kernel_size=3, padding=1)]
+    # every second extra conv is a source
+    for k, v in enumerate(extra_layers[1::2], 2):
+        head_layers += [nn.Conv2d(out_channels(v), cfg[k] * (4 + num_classes),
+                                  kernel_size=3, padding=1)]
+    return vgg, extra_layers, head_layers
 
 
 base = {
@@ -322,7 +754,13 @@ def build_ssd(phase, size=300, num_classes=21, batch_norm=False):
         print("Error: Sorry only SSD300 is supported currently!")
         return
 
+    if phase == 'test':
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision('high')
+
     # change the input channel from i=3 to 12
-    return SSD(phase, *multibox(vgg(base[str(size)], i=12, batch_norm=batch_norm),
-                                add_extras(extras[str(size)], 1024, batch_norm),
-                                mbox[str(size)], num_classes, batch_norm), num_classes, batch_norm)
+    model = SSD(phase, *multibox(vgg(base[str(size)], i=12, batch_norm=batch_norm),
+                                 add_extras(extras[str(size)], 1024, batch_norm),
+                                 mbox[str(size)], num_classes, batch_norm), num_classes, batch_norm)
+    return model.to(memory_format=torch.channels_last)